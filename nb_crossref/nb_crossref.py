@@ -1,38 +1,91 @@
 #!/usr/bin/env python3
 """Cross reference in Jupyter notebook files."""
 import argparse
-import itertools
+import os
 import re
 import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
 from pathlib import Path
-from typing import Iterable, List, Match, Sequence, Set, Tuple, TypeVar
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Match,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
 
 T = TypeVar("T")
 
-
-def remove_duplicates(seq: Sequence[T]) -> Sequence[T]:
+# None of the patterns match across lines, so they can be applied to the whole text
+# of a notebook at once. All markers are ASCII, so the patterns work on the raw bytes
+# of a file without decoding it.
+
+# Patterns for footnotes.
+_ANY_FOOTNOTE_RE = re.compile(
+    # The negative lookbehind assertion "(?<!`)" avoids "`[^abc]`", which may appear
+    # in a Markdown text explaining regular expressions.
+    rb"(?<!`)\[\^(?P<note>[^\]\n]+)\][^\S\n]*:"
+    rb"|(?<!`)\[\^(?P<cite>[^\]\n]+)\]"
+    # HTML footnotes.
+    # Note that in double double quotation marks are escaped in JSON files.
+    rb"|<a name=\\\"cite_ref-(?P<html_cite>[^\"\n]+)\\\"></a>"
+    rb"\[<sup>\[(?P=html_cite)\]</sup>\]\(#cite_note-(?P=html_cite)\)"
+    rb"|<a name=\\\"cite_note-(?P<html_note>[^\"\n]+)\\\"></a>"
+    rb"(?P=html_note)\.&nbsp;\[\^\]\(#cite_ref-(?P=html_note)\)"
+    # Catch also old HTML code, like
+    #   [<sup id="cite_ref-1">[1]</sup>](#cite_note-1)
+    #   <span id="cite_note-1">1.</span> [^](#cite_ref-1)
+    rb"|\[<sup id=\\\"cite_ref-(?P<old_cite>[^\"\n]+)\\\">"
+    rb"\[(?P=old_cite)\]</sup>\]\(#cite_note-(?P=old_cite)\)"
+    rb"|<span id=\\\"cite_note-(?P<old_note>[^\"\n]+)\\\">"
+    rb"(?P=old_note)\.</span> \[\^\]\(#cite_ref-(?P=old_note)\)"
+)
+# Group names in _ANY_FOOTNOTE_RE for references to footnotes.
+# The others are for footnote texts.
+_FOOTNOTE_CITE_GROUPS = frozenset(("cite", "html_cite", "old_cite"))
+_FOOTNOTE_CITE_HTML = (
+    rb"<a name=\"cite_ref-%(name)s\"></a>"
+    rb"[<sup>[%(name)s]</sup>](#cite_note-%(name)s)"
+)
+_FOOTNOTE_NOTE_HTML = (
+    rb"<a name=\"cite_note-%(name)s\"></a>%(name)s.&nbsp;[^](#cite_ref-%(name)s)"
+)
+
+# Patterns for equation references.
+_ANY_EQREF_RE = re.compile(
+    rb"\\\\tag\{(?P<tag>[^}\n]+)\}"
+    rb"|\\\\eqref\{(?P<eqref>[^}\n]+)\}"
+    rb"|&NoBreak;<!-- eqref -->\((?P<html_eqref>[^)\n]+)\)"
+)
+# Group name in _ANY_EQREF_RE for tags. The others are for references.
+_EQREF_TAG_GROUP = "tag"
+_EQREF_TAG_HTML = rb"\\tag{%(name)s}"
+_EQREF_EQREF_HTML = rb"&NoBreak;<!-- eqref -->(%(name)s)"
+
+
+def remove_duplicates(seq: Iterable[T]) -> Sequence[T]:
     """Remove duplicates from the given sequence with preserving the order.
 
     >>> remove_duplicates((1, 2, 3, 1, 2, 4, 5))
     (1, 2, 3, 4, 5)
     """
-    # See https://stackoverflow.com/a/480227
-    seen: Set[T] = set()
-    seen_add = seen.add
-    return tuple(x for x in seq if not (x in seen or seen_add(x)))
+    # Dictionaries preserve the insertion order (Python 3.7+).
+    return tuple(dict.fromkeys(seq))
 
 
-def pairwise(seq: Iterable[T]) -> Iterable[Tuple[T, T]]:
-    """Return successive overlapping pairs.
+def find_duplicates(seq: Sequence[T]) -> Sequence[T]:
+    """Return elements appearing more than once in the order of appearance.
 
-    >>> tuple(pairwise((1, 2, 3, 4, 5)))
-    ((1, 2), (2, 3), (3, 4), (4, 5))
+    >>> find_duplicates((1, 2, 3, 1, 2, 4, 1))
+    (1, 2)
     """
-    # See "Itertools Recipes",
-    # https://docs.python.org/3.7/library/itertools.html#itertools-recipes
-    a, b = itertools.tee(seq)
-    next(b, None)
-    return zip(a, b)
+    return tuple(x for x, n in Counter(seq).items() if n > 1)
 
 
 def n_files_str(nfiles: int) -> str:
@@ -53,44 +106,39 @@ def n_files_str(nfiles: int) -> str:
         return f"{nfiles} files"
 
 
-def relabel_tags(input_lines: Sequence[str], tag1: str, tag2: str) -> Sequence[str]:
-    """Relabel special markup tags."""
-    # Search for "{{{{TAG1 NAME}}}}".
-    # Labels are sorted in the order of appearance of tag1.
-    n = 0
-    label_map = {}
-
-    tag1_pattern = "{{{{" + tag1 + " ([^}]+)}}}}"
-
-    for line in input_lines:
-        labels = re.findall(tag1_pattern, line)
-        for i in labels:
-            n += 1
-            label_map[i] = str(n)
-
-    if not label_map:
-        # No tag found. No relabeling needed.
-        return input_lines
-
-    # Perform relabeling.
-
-    tag_pattern = "{{{{(" + tag1 + "|" + tag2 + ") ([^}]+)}}}}"
-
-    def relabel_func(m: Match[str]) -> str:
-        name = m.group(2)
-        if name in label_map:
-            name = label_map[name]
-        return "{{{{" + m.group(1) + " " + name + "}}}}"
-
-    output_lines = []
-    for line in input_lines:
-        line = re.sub(tag_pattern, relabel_func, line)
-        output_lines.append(line)
-
-    return output_lines
-
-
-def make_footnotes(input_lines: Sequence[str], errors: List[str]) -> Sequence[str]:
+def find_notebooks(root: Path) -> Iterator[Path]:
+    """Recursively find notebook files in the directory, excluding hidden ones."""
+    # Read the entries first to close the directory before descending into it.
+    # Unreadable directories are silently skipped, as Path.glob does.
+    try:
+        with os.scandir(root) as it:
+            entries = list(it)
+    except PermissionError:
+        return
+    for entry in entries:
+        if entry.name.startswith("."):
+            # Skip hidden files and directories, e.g., ".ipynb_checkpoints".
+            continue
+        try:
+            is_dir = entry.is_dir(follow_symlinks=False)
+            is_file = not is_dir and entry.is_file()
+        except OSError:
+            continue
+        if is_dir:
+            yield from find_notebooks(Path(entry.path))
+        elif is_file and entry.name.endswith(".ipynb"):
+            yield Path(entry.path)
+
+
+def last_group(m: Match[bytes]) -> Tuple[str, bytes]:
+    """Return the name and the value of the last matched group."""
+    name = m.lastgroup
+    if name is None:
+        raise AssertionError()
+    return name, m.group(name)
+
+
+def make_footnotes(text: bytes, report: Callable[[str], None]) -> bytes:
     """Make footnotes in Markdown."""
     # Markdown:
     #   This is a footnote.[^1]
@@ -99,147 +147,87 @@ def make_footnotes(input_lines: Sequence[str], errors: List[str]) -> Sequence[st
     #   This is a footnote.<a name="cite_ref-1"></a>[<sup>[1]</sup>](#cite_note-1)
     #   <a name="cite_note-1"></a>1.&nbsp;[^](#cite_ref-1) The footnote text.
 
-    # Introduce special markups in the intermediate stage:
-    #   This is a footnote.{{{{TO_FOOTNOTE 1}}}}
-    #   {{{{FOOTNOTE 1}}}} The footnote text.
-
-    output_lines = []
+    if b"[^" not in text and b"cite_ref-" not in text:
+        # No footnotes, neither in Markdown nor in HTML.
+        return text
 
-    for line in input_lines:
-        # The negative lookbehind assertion "(?<!`)" avoids "`[^abc]`", which may appear
-        # in a Markdown text explaining regular expressions.
-        line = re.sub(
-            r"(?<!`)\[\^([^\]]+)\]\s*:",
-            r"{{{{FOOTNOTE \1}}}}",
-            line,
-        )
-        line = re.sub(
-            r"(?<!`)\[\^([^\]]+)\]",
-            r"{{{{TO_FOOTNOTE \1}}}}",
-            line,
-        )
-        # Convert HTML footnotes back with the special markups.
-        # Note that in double double quotation marks are escaped in JSON files.
-        line = re.sub(
-            r"<a name=\\\"cite_ref-([^\"]+)\\\"></a>"
-            r"\[<sup>\[\1\]</sup>\]\(#cite_note-\1\)",
-            r"{{{{TO_FOOTNOTE \1}}}}",
-            line,
-        )
-        line = re.sub(
-            r"<a name=\\\"cite_note-([^\"]+)\\\"></a>\1\.&nbsp;\[\^\]\(#cite_ref-\1\)",
-            r"{{{{FOOTNOTE \1}}}}",
-            line,
-        )
-        # Catch also old HTML code, like
-        #   [<sup id="cite_ref-1">[1]</sup>](#cite_note-1)
-        #   <span id="cite_note-1">1.</span> [^](#cite_ref-1)
-        line = re.sub(
-            r"\[<sup id=\\\"cite_ref-([^\"]+)\\\">\[\1\]</sup>\]\(#cite_note-\1\)",
-            r"{{{{TO_FOOTNOTE \1}}}}",
-            line,
-        )
-        line = re.sub(
-            r"<span id=\\\"cite_note-([^\"]+)\\\">\1\.</span> \[\^\]\(#cite_ref-\1\)",
-            r"{{{{FOOTNOTE \1}}}}",
-            line,
-        )
+    # Footnotes are numbered in the order of appearance of their references.
+    # This has to be done before the conversion because a footnote text may
+    # appear before its reference.
+    labels = []
 
-        output_lines.append(line)
+    for m in _ANY_FOOTNOTE_RE.finditer(text):
+        kind, name = last_group(m)
+        if kind in _FOOTNOTE_CITE_GROUPS:
+            labels.append(name)
 
-    # Relabeling.
+    label_map = {name: b"%d" % n for n, name in enumerate(labels, 1)}
 
-    output_lines = list(relabel_tags(output_lines, "TO_FOOTNOTE", "FOOTNOTE"))
+    # Convert to HTML with relabeling, collecting the (decoded) names for checking
+    # the consistency.
 
-    # Convert to HTML.
+    cites = []
+    footnotes = []
 
-    input_lines = output_lines
-    output_lines = []
+    def to_html(m: Match[bytes]) -> bytes:
+        kind, name = last_group(m)
+        name = label_map.get(name, name)
+        if kind in _FOOTNOTE_CITE_GROUPS:
+            cites.append(name.decode())
+            return _FOOTNOTE_CITE_HTML % {b"name": name}
+        else:
+            footnotes.append(name.decode())
+            return _FOOTNOTE_NOTE_HTML % {b"name": name}
 
-    for line in input_lines:
-        line = re.sub(
-            r"{{{{TO_FOOTNOTE ([^}]+)}}}}",
-            r"<a name=\"cite_ref-\1\"></a>[<sup>[\1]</sup>](#cite_note-\1)",
-            line,
-        )
-        line = re.sub(
-            r"{{{{FOOTNOTE ([^}]+)}}}}",
-            r"<a name=\"cite_note-\1\"></a>\1.&nbsp;[^](#cite_ref-\1)",
-            line,
-        )
-        output_lines.append(line)
+    output_text = _ANY_FOOTNOTE_RE.sub(to_html, text)
 
     # Check if footnotes are consistent.
 
-    cites = []
-    footnotes = []
-
-    for line in input_lines:
-        cites += re.findall(r"{{{{TO_FOOTNOTE ([^}]+)}}}}", line)
-        footnotes += re.findall(r"{{{{FOOTNOTE ([^}]+)}}}}", line)
-
     cites_set = set(cites)
     footnotes_set = set(footnotes)
 
-    cites_not_found = []
-    footnotes_not_found = []
-
-    for i in remove_duplicates(cites):
-        if i not in footnotes_set:
-            cites_not_found.append(i)
+    cites_not_found = remove_duplicates(i for i in cites if i not in footnotes_set)
+    footnotes_not_found = remove_duplicates(i for i in footnotes if i not in cites_set)
 
-    for i in remove_duplicates(footnotes):
-        if i not in cites_set:
-            footnotes_not_found.append(i)
+    cites_duplicates = find_duplicates(cites)
+    footnotes_duplicates = find_duplicates(footnotes)
 
-    cites_duplicates = []
-    footnotes_duplicates = []
-
-    cites_seen = set()
-    footnotes_seen = set()
+    wrongly_ordered = []
 
-    for i in cites:
-        if i in cites_seen:
-            cites_duplicates.append(i)
-        else:
-            cites_seen.add(i)
+    # Compare adjacent numeric labels, parsing each of them only once.
+    prev, prev_n = "", -1
 
     for i in footnotes:
-        if i in footnotes_seen:
-            footnotes_duplicates.append(i)
-        else:
-            footnotes_seen.add(i)
-
-    wrongly_ordered = []
-
-    for i, j in pairwise(footnotes):
-        if i.isdigit() and j.isdigit() and int(i) > int(j):
-            wrongly_ordered.append((i, j))
+        if not i.isdigit():
+            prev_n = -1
+            continue
+        n = int(i)
+        if prev_n > n:
+            wrongly_ordered.append((prev, i))
+        prev, prev_n = i, n
 
     if cites_not_found:
-        errors.append(f"Footnotes not found: {', '.join(cites_not_found)}")
+        report(f"Footnotes not found: {', '.join(cites_not_found)}")
 
     if footnotes_not_found:
-        errors.append(f"Footnotes not referenced: {', '.join(footnotes_not_found)}")
+        report(f"Footnotes not referenced: {', '.join(footnotes_not_found)}")
 
     if cites_duplicates:
-        errors.append(
-            f"Duplicated references of footnotes: {', '.join(cites_duplicates)}"
-        )
+        report(f"Duplicated references of footnotes: {', '.join(cites_duplicates)}")
 
     if footnotes_duplicates:
-        errors.append(f"Duplicated footnotes: {', '.join(footnotes_duplicates)}")
+        report(f"Duplicated footnotes: {', '.join(footnotes_duplicates)}")
 
     if wrongly_ordered:
-        errors.append(
+        report(
             "Wrongly ordered footnotes: "
             f"{', '.join(f'({i}, {j})' for i, j in wrongly_ordered)}"
         )
 
-    return output_lines
+    return output_text
 
 
-def make_eqrefs(input_lines: Sequence[str], errors: List[str]) -> Sequence[str]:
+def make_eqrefs(text: bytes, report: Callable[[str], None]) -> bytes:
     """Make equation references in Markdown."""
     # Markdown:
     #   \tag{1}
@@ -253,126 +241,149 @@ def make_eqrefs(input_lines: Sequence[str], errors: List[str]) -> Sequence[str]:
     # "&NoBreak;" is prepended to avoid being recognized as an HTML block
     # in GitHub Flavored Markdown when \eqref is at the beginning of a line.
 
-    # Introduce special markups in the intermediate stage:
-    #   {{{{TAG 1}}}}
-    #   {{{{EQREF 1}}}}
-
-    output_lines = []
-
-    for line in input_lines:
-        line = re.sub(r"\\\\tag\{([^}]+)\}", r"{{{{TAG \1}}}}", line)
-        line = re.sub(r"\\\\eqref\{([^}]+)\}", r"{{{{EQREF \1}}}}", line)
-
-        # Convert HTML back to the markups.
-        line = re.sub(r"&NoBreak;<!-- eqref -->\(([^)]+)\)", r"{{{{EQREF \1}}}}", line)
-
-        output_lines.append(line)
+    if (
+        rb"\\tag{" not in text
+        and rb"\\eqref{" not in text
+        and b"<!-- eqref -->" not in text
+    ):
+        # No equation tags or references.
+        return text
 
-    # Relabeling.
+    # Equations are numbered in the order of appearance of their tags.
+    # This has to be done before the conversion because a reference may appear
+    # before its tag.
+    labels = []
 
-    output_lines = list(relabel_tags(output_lines, "TAG", "EQREF"))
+    for m in _ANY_EQREF_RE.finditer(text):
+        kind, name = last_group(m)
+        if kind == _EQREF_TAG_GROUP:
+            labels.append(name)
 
-    # Convert to HTML.
+    label_map = {name: b"%d" % n for n, name in enumerate(labels, 1)}
 
-    input_lines = output_lines
-    output_lines = []
-
-    for line in input_lines:
-        line = re.sub(
-            r"{{{{TAG ([^}]+)}}}}",
-            r"\\\\tag{\1}",
-            line,
-        )
-        line = re.sub(
-            r"{{{{EQREF ([^}]+)}}}}",
-            r"&NoBreak;<!-- eqref -->(\1)",
-            line,
-        )
-        output_lines.append(line)
-
-    # Check the consistency.
+    # Convert to HTML with relabeling, collecting the (decoded) names for checking
+    # the consistency.
 
     tags = []
     eqrefs = []
 
-    for line in input_lines:
-        tags += re.findall(r"{{{{TAG ([^}]+)}}}}", line)
-        eqrefs += re.findall(r"{{{{EQREF ([^}]+)}}}}", line)
-
-    tags_set = set(tags)
+    def to_html(m: Match[bytes]) -> bytes:
+        kind, name = last_group(m)
+        name = label_map.get(name, name)
+        if kind == _EQREF_TAG_GROUP:
+            tags.append(name.decode())
+            return _EQREF_TAG_HTML % {b"name": name}
+        else:
+            eqrefs.append(name.decode())
+            return _EQREF_EQREF_HTML % {b"name": name}
 
-    eqrefs_not_found = []
+    output_text = _ANY_EQREF_RE.sub(to_html, text)
 
-    for i in remove_duplicates(eqrefs):
-        if i not in tags_set:
-            eqrefs_not_found.append(i)
+    # Check the consistency.
 
-    tags_duplicates = []
+    tags_set = set(tags)
 
-    tags_seen = set()
+    eqrefs_not_found = remove_duplicates(i for i in eqrefs if i not in tags_set)
 
-    for i in tags:
-        if i in tags_seen:
-            tags_duplicates.append(i)
-        else:
-            tags_seen.add(i)
+    tags_duplicates = find_duplicates(tags)
 
     if eqrefs_not_found:
-        errors.append(f"Tags not found: {', '.join(eqrefs_not_found)}")
+        report(f"Tags not found: {', '.join(eqrefs_not_found)}")
 
     if tags_duplicates:
-        errors.append(f"Duplicated tags: {', '.join(tags_duplicates)}")
+        report(f"Duplicated tags: {', '.join(tags_duplicates)}")
 
-    return output_lines
+    return output_text
 
 
 def process_file(path: Path, errors: List[str]) -> bool:
     """Process the specified file."""
-    local_errors: List[str] = []
+    header_shown = False
 
-    input_lines = path.read_text().splitlines()
+    def report(message: str) -> None:
+        nonlocal header_shown
+        if not header_shown:
+            errors.append(f"Error: in file {path}:")
+            header_shown = True
+        errors.append(message)
 
-    output_lines = make_footnotes(input_lines, local_errors)
-    output_lines = make_eqrefs(output_lines, local_errors)
+    text = path.read_bytes()
 
-    if local_errors:
-        errors.append(f"Error: in file {path}:")
-        errors.extend(local_errors)
+    new_text = make_footnotes(text, report)
+    new_text = make_eqrefs(new_text, report)
 
-    if input_lines != output_lines:
-        path.write_text("\n".join(output_lines) + "\n")
+    if new_text != text:
+        path.write_bytes(new_text)
         return True
 
     return False
 
 
+def process_file_worker(path: Path) -> Tuple[bool, List[str]]:
+    """Process the specified file and return whether it changed and errors."""
+    errors: List[str] = []
+    try:
+        changed = process_file(path, errors)
+    except OSError as e:
+        # Report it as an error of this file so that the other files are still
+        # processed and reported.
+        errors.append(f"Error: {e}")
+        changed = False
+    return changed, errors
+
+
 def main() -> None:
     """Entry point."""
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument(
         "files", type=Path, nargs="*", help="source files to be processed"
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="number of parallel processes (default: number of CPUs)",
+    )
     args = parser.parse_args()
 
-    n_files = 0
-    n_changed = 0
-    errors: List[str] = []
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("--jobs must be a positive integer")
 
-    def do_process_file(path: Path) -> None:
-        nonlocal n_files, n_changed
-        n_files += 1
-        if process_file(path, errors):
-            print(f"Changed: {path}")
-            n_changed += 1
+    paths: List[Path] = []
 
     for source_path in args.files:
         if source_path.is_dir():
-            # glob excluding hidden files
-            for path in source_path.glob("**/*.ipynb"):
-                if not any(part.startswith(".") for part in path.parts):
-                    do_process_file(path)
+            paths.extend(find_notebooks(source_path))
+        else:
+            paths.append(source_path)
+
+    # The same file may be given more than once, e.g., both directly and via its
+    # directory. Process it only once: otherwise two workers could read and write
+    # the file concurrently.
+    unique_paths: Dict[Path, Path] = {}
+    for path in paths:
+        unique_paths.setdefault(path.resolve(), path)
+    paths = list(unique_paths.values())
+
+    n_files = len(paths)
+    n_changed = 0
+    errors: List[str] = []
+
+    with ExitStack() as stack:
+        # Files are independent of each other and can be processed in parallel.
+        results: Iterable[Tuple[bool, List[str]]]
+        if len(paths) > 1 and args.jobs != 1:
+            executor = stack.enter_context(ProcessPoolExecutor(args.jobs))
+            results = executor.map(process_file_worker, paths)
         else:
-            do_process_file(source_path)
+            results = map(process_file_worker, paths)
+
+        # Report the results as they come, in the order of the files.
+        for path, (changed, file_errors) in zip(paths, results):
+            if changed:
+                print(f"Changed: {path}")
+                n_changed += 1
+            errors.extend(file_errors)
 
     print(
         f"{n_files_str(n_files).capitalize()} processed. "
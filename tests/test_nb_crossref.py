@@ -0,0 +1,179 @@
+import os
+import sys
+from pathlib import Path
+from typing import Any, Callable, List, Tuple
+
+import pytest
+
+from nb_crossref.nb_crossref import find_notebooks, main, make_eqrefs, make_footnotes
+
+
+def run(
+    func: Callable[[bytes, Callable[[str], None]], bytes], text: bytes
+) -> Tuple[bytes, List[str]]:
+    errors: List[str] = []
+    return func(text, errors.append), errors
+
+
+# Note that double quotation marks are escaped in JSON files.
+CITE_1 = rb"<a name=\"cite_ref-1\"></a>[<sup>[1]</sup>](#cite_note-1)"
+CITE_2 = rb"<a name=\"cite_ref-2\"></a>[<sup>[2]</sup>](#cite_note-2)"
+NOTE_1 = rb"<a name=\"cite_note-1\"></a>1.&nbsp;[^](#cite_ref-1)"
+NOTE_2 = rb"<a name=\"cite_note-2\"></a>2.&nbsp;[^](#cite_ref-2)"
+
+
+def test_make_footnotes() -> None:
+    text = b"a[^x] b[^y]\n[^x]: X\n[^y]: Y\n"
+    expected = b"a" + CITE_1 + b" b" + CITE_2 + b"\n"
+    expected += NOTE_1 + b" X\n" + NOTE_2 + b" Y\n"
+
+    assert run(make_footnotes, text) == (expected, [])
+    # Idempotent.
+    assert run(make_footnotes, expected) == (expected, [])
+
+
+def test_make_footnotes_old_html() -> None:
+    text = (
+        rb"a[<sup id=\"cite_ref-7\">[7]</sup>](#cite_note-7)"
+        b"\n"
+        rb"<span id=\"cite_note-7\">7.</span> [^](#cite_ref-7) X"
+        b"\n"
+    )
+
+    assert run(make_footnotes, text) == (b"a" + CITE_1 + b"\n" + NOTE_1 + b" X\n", [])
+
+
+def test_make_footnotes_relabel_order() -> None:
+    # Numbered in the order of the references, not of the footnote texts.
+    text = b"[^y]: Y\n[^x]: X\na[^x] b[^y]\n"
+    expected = NOTE_2 + b" Y\n" + NOTE_1 + b" X\na" + CITE_1 + b" b" + CITE_2 + b"\n"
+
+    assert run(make_footnotes, text) == (
+        expected,
+        ["Wrongly ordered footnotes: (2, 1)"],
+    )
+
+
+def test_make_footnotes_code_span() -> None:
+    text = b"Regex `[^abc]` matches any other character.\n"
+
+    assert run(make_footnotes, text) == (text, [])
+
+
+def test_make_footnotes_errors() -> None:
+    text = b"a[^x] b[^x] c[^x] d[^w]\n[^x]: X\n[^x]: X\n[^z]: Z\n"
+
+    assert run(make_footnotes, text)[1] == [
+        "Footnotes not found: 4",
+        "Footnotes not referenced: z",
+        # Reported once, even though referenced three times.
+        "Duplicated references of footnotes: 3",
+        "Duplicated footnotes: 3",
+    ]
+
+
+def test_make_eqrefs() -> None:
+    text = rb"$$a \\tag{x}$$ \\eqref{x}"
+    expected = rb"$$a \\tag{1}$$ &NoBreak;<!-- eqref -->(1)"
+
+    assert run(make_eqrefs, text) == (expected, [])
+    # Idempotent.
+    assert run(make_eqrefs, expected) == (expected, [])
+
+
+def test_make_eqrefs_relabel_order() -> None:
+    # The reference appears before its tag.
+    text = rb"\\eqref{y} \\tag{x} \\tag{y}"
+    expected = rb"&NoBreak;<!-- eqref -->(2) \\tag{1} \\tag{2}"
+
+    assert run(make_eqrefs, text) == (expected, [])
+
+
+def test_make_eqrefs_errors() -> None:
+    text = rb"\\tag{x} \\tag{x} \\tag{x} \\eqref{z}"
+
+    assert run(make_eqrefs, text)[1] == [
+        "Tags not found: z",
+        # Reported once, even though tagged three times.
+        "Duplicated tags: 3",
+    ]
+
+
+def test_find_notebooks(tmp_path: Path) -> None:
+    (tmp_path / "a.ipynb").touch()
+    (tmp_path / "b.txt").touch()
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "c.ipynb").touch()
+    (tmp_path / ".ipynb_checkpoints").mkdir()
+    (tmp_path / ".ipynb_checkpoints" / "a-checkpoint.ipynb").touch()
+
+    assert sorted(find_notebooks(tmp_path)) == [
+        tmp_path / "a.ipynb",
+        tmp_path / "sub" / "c.ipynb",
+    ]
+
+
+def test_find_notebooks_unreadable_dir(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    (tmp_path / "a.ipynb").touch()
+    (tmp_path / "locked").mkdir()
+    (tmp_path / "locked" / "b.ipynb").touch()
+
+    # Simulate "chmod 000", which has no effect when the tests run as root.
+    orig_scandir = os.scandir
+
+    def scandir(path: Any) -> Any:
+        if Path(path).name == "locked":
+            raise PermissionError(path)
+        return orig_scandir(path)
+
+    monkeypatch.setattr(os, "scandir", scandir)
+
+    assert sorted(find_notebooks(tmp_path)) == [tmp_path / "a.ipynb"]
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_main_missing_file(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    capsys: pytest.CaptureFixture[str],
+    jobs: str,
+) -> None:
+    monkeypatch.chdir(tmp_path)
+    Path("a.ipynb").write_text('"a[^x]\\n",\n"[^x]: note\\n"\n')
+    monkeypatch.setattr(
+        sys, "argv", ["nb-crossref", "-j", jobs, "a.ipynb", "missing.ipynb"]
+    )
+
+    with pytest.raises(SystemExit) as excinfo:
+        main()
+
+    assert excinfo.value.code == 1
+    out, err = capsys.readouterr()
+    assert out == "Changed: a.ipynb\n2 files processed. 1 file changed.\n"
+    assert "missing.ipynb" in err
+
+
+def test_main_duplicated_file(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    capsys: pytest.CaptureFixture[str],
+) -> None:
+    monkeypatch.chdir(tmp_path)
+    Path("a.ipynb").write_text('"a[^x]\\n",\n"[^x]: note\\n"\n')
+    # The same file given directly, via another spelling and via its directory.
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["nb-crossref", "-j", "2", "a.ipynb", str(tmp_path / "a.ipynb"), "."],
+    )
+
+    main()
+
+    out, err = capsys.readouterr()
+    assert out == "Changed: a.ipynb\n1 file processed. 1 file changed.\n"
+    assert err == ""
+    assert Path("a.ipynb").read_bytes() == (
+        b'"a' + CITE_1 + b'\\n",\n"' + NOTE_1 + b' note\\n"\n'
+    )